@@ -3,6 +3,7 @@ Create Kafka topic(s) with 3 partitions and 1 replication factor
 """
 
 from confluent_kafka.admin import AdminClient, NewTopic
+import concurrent.futures
 
 
 a = AdminClient({'bootstrap.servers': 'localhost:29092, localhost:29093'})
@@ -15,16 +16,19 @@ new_topics = [NewTopic(topic, num_partitions=3, replication_factor=1) for topic
 print("new_topics objects=", new_topics)
 
 # Use the Admin API to create topics, passing the NewTopic objects
-# A dict of <topic: future> is returned
-fs = a.create_topics(new_topics)
+# A dict of <topic: future> is returned. operation_timeout is how long the broker waits for the topics to be created.
+# request_timeout is the client's overall limit, including that wait, so it must be the longer of the two
+fs = a.create_topics(new_topics, operation_timeout=30, request_timeout=45)
 
 # Display the fs object
 print("fs objects=", fs)
 
-# Wait for the operation to finish
-for topic, f in fs.items():
+# Report each topic as soon as its operation finishes, rather than waiting on them in order
+topics_by_future = {f: topic for topic, f in fs.items()}
+for f in concurrent.futures.as_completed(topics_by_future):
+    topic = topics_by_future[f]
     try:
         f.result()      # the result itself is None
-        print("Topic {} created".format(topic))
+        print(f"Topic {topic} created")
     except Exception as e:
-        print("Failed to create topic {}: {}".format(topic, e))
+        print(f"Failed to create topic {topic}: {e}")
@@ -7,17 +7,107 @@ from confluent_kafka import Producer, KafkaException
 import sys
 import re
 import json
+import html
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from lxml import html as lxml_html
 import zipfile
 import os
 import fnmatch
 import tempfile
+import shutil
 import time
+import functools
+import itertools
+import io
+import concurrent.futures
+import threading
+import collections
+
+try:
+    import orjson       # C implemented JSON encoder. Falls back to the standard library if it isn't installed
+except ImportError:
+    orjson = None
+
+
+# Archives up to this size are downloaded into memory. Larger ones are written to a temporary file
+MAX_IN_MEMORY_ARCHIVE_BYTES = 16 * 1024 * 1024
+
+# Books are sent as a sequence of messages of up to this many characters, split on line boundaries. Even fully escaped
+# as JSON this keeps each message well under Kafka's default 1MB max message size
+BOOK_CHUNK_SIZE = 65536
+
+# Running totals of message delivery results, updated by delivery_report. Callbacks can be served from any worker
+# thread which polls the shared producer, so updates are made under the lock
+delivery_stats = {"delivered": 0, "failed": 0}
+delivery_stats_lock = threading.Lock()
+
+# Most recent delivery errors, reported once at the end rather than written to stderr as each one happens
+delivery_errors = collections.deque(maxlen=100)
+
+
+def encode_json(obj):
+    """
+    Serialises an object to JSON encoded as UTF-8 bytes, ready to be sent to Kafka
+    :param obj: object to serialise
+    :return: bytes containing the JSON document
+    """
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=32)
+def compile_regex(pattern, flags=0):
+    """
+    Compiles a regex pattern once and caches it, so hot loops don't pay for the re module's cache lookup on every call
+    :param pattern: regular expression to compile
+    :param flags: re module flags to compile the pattern with
+    :return: compiled regular expression object
+    """
+    return re.compile(pattern, flags)
+
+
+def create_http_session(pool_size):
+    """
+    Creates a HTTP session which keeps connections alive between requests, saving a TCP handshake on each download
+    :param pool_size: max connections to keep open per host. Should be at least the number of concurrent downloads
+    :return: requests Session object. Safe to share between threads
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def extract_href_links(html_page):
+    """
+    Returns the href of every anchor in a HTML page, in page order
+    The Gutenberg harvest pages are simple enough for a regex over the raw bytes to find the links without building a
+    parse tree. Falls back to a full HTML parse if the regex finds nothing
+    :param html_page: raw bytes of the HTML page
+    :return: list containing the href links
+    """
+    # href must be a whole attribute name (not e.g. data-href). The value can be double, single or unquoted
+    href_regex = compile_regex(rb"<a\s(?:[^>]*?\s)?href\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s\"'>]+))", re.IGNORECASE)
+    comment_regex = compile_regex(rb"<!--.*?-->", re.DOTALL)
+
+    # Anchors which have been commented out aren't part of the page
+    html_page = comment_regex.sub(b"", html_page)
+
+    # The regex sees the raw markup, so entities such as &amp; in the query strings need to be decoded.
+    # Only one of the three alternatives matches, which is always the last group to take part in the match
+    hrefs = [html.unescape(match.group(match.lastindex).decode("utf-8", errors="replace"))
+             for match in href_regex.finditer(html_page)]
+    if not hrefs:
+        hrefs = lxml_html.fromstring(html_page).xpath("//a/@href")
+
+    return hrefs
 
 
 def retrieve_archive_links(base_url_address, start_uri, required_num_links, timeout=5,
-                           file_name_regex="^http.+zip$", sleep_interval=0.5):
+                           file_name_regex="^http.+zip$", sleep_interval=0.5, session=requests):
     """
     Iterate through paginated HTML pages until the requested number of archive href links are retrieved
     :param base_url_address: Base URL which all the paginated URIs exist under
@@ -26,70 +116,51 @@ def retrieve_archive_links(base_url_address, start_uri, required_num_links, time
     :param file_name_regex: Regex used to match filenames to ensure we are matching only archive files
     :param timeout: Max timeout for HTML requests.
     :param sleep_interval: time (in seconds) to rest between each HTML request. Avoids overloading the server
+    :param session: requests Session used to reuse connections between pages. Defaults to a new connection per page
     :return: List containing the href links. False for any failures
     """
 
     links_retrieved = 0
     current_uri = start_uri
     extracted_href_links = []
+    file_name_pattern = compile_regex(file_name_regex)
 
-    print("Looking for {} links from {}".format(required_num_links, base_url_address))
+    print(f"Looking for {required_num_links} links from {base_url_address}")
 
     # Iterate until the total number of requested links has been retrieved for the paginated HTML pages
     while links_retrieved < required_num_links:
         try:
-            r = requests.get(base_url_address + current_uri, timeout=timeout)
-            html_page = r.text
+            r = session.get(base_url_address + current_uri, timeout=timeout)
+            html_page = r.content       # raw bytes. Links are extracted without decoding the whole page
 
         except requests.ConnectionError as e:
-            print("Connection error. Please retry later: ".format(e))
+            print(f"Connection error. Please retry later: {e}")
             return False
 
         except requests.Timeout as e:
-            print("Request timed out: {} (set to {} seconds). Please retry later".format(e, timeout))
+            print(f"Request timed out: {e} (set to {timeout} seconds). Please retry later")
             return False
 
         # Parse the HTML page for href links
-        soup = BeautifulSoup(html_page, "html.parser")
+        hrefs = extract_href_links(html_page)
 
-        soup_links = soup.find_all("a")
-        for link in soup_links:
-            # Ensure the link matches our desired filename pattern
-            if re.search(file_name_regex, link.get("href")):
-                extracted_href_links.append(link.get("href"))
+        # Ensure the links match our desired filename pattern
+        extracted_href_links.extend([href for href in hrefs if file_name_pattern.search(href)])
 
         links_retrieved = len(extracted_href_links)
 
         # The next page link is always the last href on the page
-        next_uri = soup_links[-1].get("href")
-        print("Retrieved {} links; Current_uri: {}; Next_uri: {}; Query_time: {}s"
-              .format(links_retrieved, current_uri, next_uri, r.elapsed.total_seconds()))
+        next_uri = hrefs[-1]
+        print(f"Retrieved {links_retrieved} links; Current_uri: {current_uri}; Next_uri: {next_uri}; "
+              f"Query_time: {r.elapsed.total_seconds()}s")
 
         current_uri = next_uri
-        time.sleep(sleep_interval)             # Reduce load on the remote server
-
-    return extracted_href_links
 
+        # Reduce load on the remote server. No need to wait once the last page has been retrieved
+        if links_retrieved < required_num_links:
+            time.sleep(sleep_interval)
 
-def find_files_in_directory(pattern, path):
-    """
-    Returns a list of files which match a filename pattern within the directory path, including subdirectories
-    :param pattern: shell glob style pattern to match against filenames
-    :param path: the base directory to start the search from
-    :return: list of files which match the pattern. Return 0 if it isn't a directory
-    """
-    # Check the path is a directory
-    if os.path.isdir(path):
-        found_files = []
-        # Iterate through all directories (inc. sub directories), and compare the filename against the pattern
-        for root, dirs, files in os.walk(path):
-            for name in files:
-                if fnmatch.fnmatch(name, pattern):
-                    found_files.append(os.path.join(root, name))
-        return found_files
-    else:
-        print("ERR: {} is not a directory".format(path))
-        return 0
+    return extracted_href_links
 
 
 def display_producer_stats(success_objects, failure_objects):
@@ -106,21 +177,27 @@ def display_producer_stats(success_objects, failure_objects):
     if success_objects:
         print("Successful tasks:\n===================")
         for success in success_objects:
-            print("{} ({})".format(success["book_title"].rstrip(), success["file_path"]))
+            print(f"{success['book_title']} ({success['file_path']})")
 
     if failure_objects:
         print("\nFailed tasks:\n===================")
         for failure in failure_objects:
-            print("URL: {}".format(failure))
+            print(f"URL: {failure}")
+
+    print(f"\nSuccessfully processed {len(success_objects)} archives\n"
+          f"Failed to process {len(failure_objects)} archives")
 
-    print("\nSuccessfully processed {} archives\nFailed to process {} archives"
-          .format(len(success_objects), len(failure_objects)))
+    print(f"\nDelivered {delivery_stats['delivered']} messages to Kafka\n"
+          f"Failed to deliver {delivery_stats['failed']} messages")
+
+    if delivery_errors:
+        print(f"% Sample of message delivery errors: {list(delivery_errors)[:5]}", file=sys.stderr)
 
 
 def delivery_report(err, msg):
     """
     Called once for each message produced to indicate delivery result (to brokers)
-    Triggered by poll() or flush()
+    Triggered by poll() or flush(). Totals are kept in delivery_stats and recent errors in delivery_errors
 
     :param err: contains error information from callbacks
     :param msg: contains information from callbacks
@@ -130,140 +207,188 @@ def delivery_report(err, msg):
 
     if err:
         # error
-        print("% Message failed delivery {}".format(err), file=sys.stderr)
-    # else:
-    #     # success
-    #     print("% Message delivered to {} [{}] @ {}".format(msg.topic(), msg.partition(), msg.offset()))
+        delivery_errors.append(err)
+        with delivery_stats_lock:
+            delivery_stats["failed"] += 1
+    else:
+        # success
+        with delivery_stats_lock:
+            delivery_stats["delivered"] += 1
+
+
+def kafka_error_report(err):
+    """
+    Called for client level errors which aren't tied to a single message, e.g. all brokers being unreachable
+    Triggered by poll() or flush()
+
+    :param err: contains error information from callbacks
+
+    :return None
+    """
+
+    print(f"% Kafka client error: {err}", file=sys.stderr)
 
 
-def produce_kafka_message(client, topic, message):
+def produce_kafka_message(client, topic, message, key=None):
     """
     Produces a single message to a Kafka topic
 
     :param client: handle to the Kakfa Producer object
     :param topic: which Kafka topic to write to
     :param message: the message to write to the Kafka topic
+    :param key: optional message key. Messages with the same key are always written to the same partition
 
-    :return None
+    :return True if the message was queued for delivery. False on failure
     """
-    try:
-        client.produce(topic, message, callback=delivery_report)
-        return None
+    queue_full_reported = False     # only report a full queue once per message, not on every retry
 
-    except KafkaException as e:
-        print("% Kafka exception: {}".format(e), file=sys.stderr)
+    while True:
+        try:
+            client.produce(topic, value=message, key=key, callback=delivery_report)
+            break
 
-    except BufferError:
-        print("% Local producer queue is full ({} messages awaiting delivery): try again".format(len(client)))
+        except KafkaException as e:
+            print(f"% Kafka exception: {e}", file=sys.stderr)
+            return False
+
+        except BufferError:
+            # Local queue is full. Serve delivery callbacks to free up space, then retry
+            if not queue_full_reported:
+                print(f"% Local producer queue is full ({len(client)} messages awaiting delivery): retrying")
+                queue_full_reported = True
+            client.poll(0.1)
+
+    # Trigger any queued delivery callbacks without blocking
+    client.poll(0)
+    return True
 
 
-def read_text_file_to_list(path):
+def decode_book_bytes(data):
     """
-    Reads a text file and returns a list of the lines
-    :param path: path to the text file
-    :return list containing each line as an item. Return False if unable to complete successfully
+    Decodes the raw bytes of a book to a string
+    Most books are UTF-8. Project Gutenberg's '-8' editions are ISO-8859-1 (Latin-1), which can decode any byte, so it
+    is used as a lossless fallback when the bytes aren't valid UTF-8
+    :param data: raw bytes of the text file
+    :return string containing the decoded text
     """
     try:
-        file = open(path, "r")
-        # Reads all lines and splits to list
-        return file.readlines()
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
 
-    except FileNotFoundError:
-        print("WARN: Unable to find file: {}".format(path))
-        return False
 
-    except UnicodeDecodeError:
-        print("WARN: Unable to decode file: {}".format(path))
-        return False
+def read_archive_file_to_string(archive, name):
+    """
+    Reads a text file inside a zip archive straight into a string, without extracting it to disk
+    :param archive: open ZipFile object containing the text file
+    :param name: name of the text file within the archive
+    :return string containing the contents of text file
+    """
+    # Match text mode by normalising Windows line endings, as used by many Project Gutenberg files
+    return decode_book_bytes(archive.read(name)).replace("\r\n", "\n")
 
 
-def read_text_file_to_string(path):
+def split_text_into_chunks(text, max_chunk_size=BOOK_CHUNK_SIZE):
     """
-    Reads a text file and returns a string
-    :param path: path to the text file
-    :return string containing the contents of text file. Return False if unable to complete successfully
+    Splits text into chunks of at most max_chunk_size characters
+    Chunks end on a line boundary, unless a single line is longer than max_chunk_size
+
+    :param text: string to split
+    :param max_chunk_size: max number of characters in each chunk
+    :return list of strings which join back together into the original text
     """
-    try:
-        file = open(path, "r")
-        return file.read()
+    chunks = []
+    start = 0
 
-    except FileNotFoundError:
-        print("WARN: Unable to find file: {}".format(path))
-        return False
+    while start < len(text):
+        end = start + max_chunk_size
+        if end < len(text):
+            # Break after the last newline in the chunk so lines aren't split across messages
+            last_newline = text.rfind("\n", start, end)
+            if last_newline != -1:
+                end = last_newline + 1
+        chunks.append(text[start:end])
+        start = end
 
-    except UnicodeDecodeError:
-        print("WARN: Unable to decode file: {}".format(path))
-        return False
+    return chunks
 
 
-def find_book_title_in_text_file(path, regex_prefix="^Title:"):
+def find_book_title_in_lines(lines, regex_prefix="^Title:"):
     """
-    Retrieves the book title from a text file
+    Retrieves the book title from the lines of a text file
     Assumes the title is always prefixed with the regex_prefix, and in the top section, as with Project Gutenberg
-    Uses the regex to locate the line containing the title. Ensures only a single entry is matched
+    Runs the regex once over the joined top lines to find the title. Ensures only a single entry is matched
 
-    :param path: path to the text file
+    :param lines: iterable of lines from the top of the text file (list or file iterator)
     :param regex_prefix: regex for describing the string prefix before the title information in the file
     :return False on no match or multiple matches. On a single match the string containing the title is returned
     """
 
-    title_line = None           # the title to return
-    count_matched = 0           # the number of matches. Ensures we only have one match for consistency
-
-    lines = read_text_file_to_list(path)
-    # Check for a successful response
-    if lines:
-        # Iterate through the lines looking for the one containing the string prefix
-        # We only need to use a slice as the title information is always included in the top section of the text file
-        for line in lines[0:100]:
-            if re.search(regex_prefix, line, flags=re.IGNORECASE):
-                # Matching line found
-                length_of_string_prefix = len(regex_prefix)     # used to determine the start position of the title
-                title_line = line[length_of_string_prefix:]     # remove the prefix from the string
-                count_matched += 1
-
-        # Check whether we have found a match
-        if count_matched == 1:
-            # Found exactly one match - success
-            return title_line
-        else:
-            # no matches or multiple matches - failure
-            return False
+    # Capture the rest of the line after the prefix. MULTILINE lets a '^' in the prefix match at the start of each line.
+    # The title is a named group, so any capturing groups in the prefix itself don't change which group is returned
+    title_regex = compile_regex(f"(?:{regex_prefix})(?P<book_title>.*)", re.IGNORECASE | re.MULTILINE)
+
+    # We only need the first lines as the title information is always included in the top section of the text file
+    head = "".join(itertools.islice(lines, 100))
+
+    # Stop scanning at a second match, as that is already enough to reject the book
+    matches = list(itertools.islice(title_regex.finditer(head), 2))
+
+    # Check whether we have found a match
+    if len(matches) == 1:
+        # Found exactly one match - success
+        return matches[0].group("book_title").strip()
     else:
-        # Unable to establish book title
+        # no matches or multiple matches - failure
         return False
 
 
-def process_book_in_full(client, file_path, prefix, kafka_topic):
+def process_book_in_full(client, archive, book_id, file_path, prefix, kafka_topic):
     """
     Process the a text file to a) determine it's title b) send the contents to a kafka broker.
-    These will be processed by a downstream kafka consumer
+    The contents are split into numbered chunks, each sent as a message keyed on the book id. Titles aren't unique
+    (e.g. the UTF-8 and Latin-1 editions of a book), so the id is what lets a downstream kafka consumer tell the chunks
+    of different books apart. Keying on it also sends every chunk of a book to the same partition
 
     :param client: handle to the Kafka Producer object
-    :param file_path: path to the text file (book)
+    :param archive: open ZipFile object containing the text file
+    :param book_id: unique identifier for the book, e.g. the URL of the archive it was downloaded from
+    :param file_path: path to the text file (book) within the archive
     :param prefix: regex for describing the string prefix before the title information in the file
     :param kafka_topic:which Kafka topic to write to
     :return Dict containing book title and path. Return False on failure
     """
 
-    # Attempt to find book title in the text
-    book_title = find_book_title_in_text_file(file_path, prefix)
-
-    if book_title:
-        print("Current file: {}\nBook Title: {}".format(file_path, book_title), end="")
+    # Read the text file once as a single string. Check it is not empty
+    full_book_as_string = read_archive_file_to_string(archive, file_path)
+    if not full_book_as_string:
+        print(f"Empty file: {file_path}")
+        return False
 
-        # Read the text file as single string. Check we could open the file and it is not empty
-        full_book_as_string = read_text_file_to_string(file_path)
-        if not full_book_as_string:
-            print("Unable to open file: {}".format(file_path))
-            return False
+    # Attempt to find book title in the text. Only the top lines of the already decoded book are scanned
+    book_title = find_book_title_in_lines(io.StringIO(full_book_as_string), prefix)
 
-        # Send Kafka message (async)
-        kafka_message_json = json.dumps({
-            "book_title": book_title,
-            "contents": full_book_as_string
-        })
-        produce_kafka_message(client=client, topic=kafka_topic, message=kafka_message_json)
+    if book_title:
+        print(f"Current file: {file_path}\nBook Title: {book_title}")
+
+        book_chunks = split_text_into_chunks(full_book_as_string)
+
+        # Key on the book id so each book is consistently routed to the same partition
+        book_key = book_id.encode("utf-8")
+
+        for chunk_number, chunk in enumerate(book_chunks):
+            # Send Kafka message (async). Encoded to bytes, which the producer accepts without re-encoding
+            kafka_message_json = encode_json({
+                "book_id": book_id,
+                "book_title": book_title,
+                "chunk_number": chunk_number,
+                "total_chunks": len(book_chunks),
+                "contents": chunk
+            })
+            if not produce_kafka_message(client=client, topic=kafka_topic, message=kafka_message_json, key=book_key):
+                # A book with a missing chunk can't be reassembled by the consumer, so fail the whole book
+                print(f"ERR: Unable to queue chunk {chunk_number} of {len(book_chunks)} for '{book_title}'")
+                return False
 
         return {
             "book_title": book_title,
@@ -271,14 +396,16 @@ def process_book_in_full(client, file_path, prefix, kafka_topic):
         }
 
     else:
-        print("Unable to retrieve the book title from the file '{}' using prefix '{}'".format(file_path, prefix))
+        print(f"Unable to retrieve the book title from the file '{file_path}' using prefix '{prefix}'")
         return False
 
 
-def process_archive(kafka_client_config, archive_url, timeout, filename_glob_pattern, title_regex_prefix, topic):
+def process_archive(client, session, archive_url, timeout, filename_glob_pattern, title_regex_prefix, topic):
     """
-    Download the archive, unpack then process the book (text file) inside by streaming it to Kafka
-    :param kafka_client_config: options to pass to the Kafka producer client. Dict.
+    Download the archive, then process the book (text file) inside by streaming it to Kafka straight from the archive
+    Safe to run from multiple threads sharing the same Kafka Producer
+    :param client: handle to the Kafka Producer object. Shared between archives
+    :param session: requests Session used to download the archive. Shared between archives
     :param archive_url: HTTP URL of the archive to be downloaded
     :param timeout: how long (in seconds) before the HTTP connection times out
     :param filename_glob_pattern: pattern used to identity books in the archive
@@ -286,58 +413,67 @@ def process_archive(kafka_client_config, archive_url, timeout, filename_glob_pat
     :param topic: which Kafka topic are we streaming the contents to
     :return: Dict result object on success. Dict containing the url of any failed to process books
     """
-    print("\n> Processing archive: {}".format(archive_url))
+    print(f"\n> Processing archive: {archive_url}")
 
     # todo: add error handling & optional sleep period
-    # Steam the download to temporary file
-    # Settings Stream=True means the download is deferred until iter_content is called
+    # Stream the download into memory, or a temporary file for large archives
+    # Settings Stream=True means the download is deferred until the response body is read
     try:
-        r = requests.get(archive_url, stream=True, timeout=timeout)
+        r = session.get(archive_url, stream=True, timeout=timeout)
     except requests.ConnectionError:
-        print("Connection error for {}. Please retry later: ".format(archive_url))
+        print(f"Connection error for {archive_url}. Please retry later")
         return {"failed_url": archive_url}
 
     except requests.Timeout:
-        print("Request timed out for {} (set to {} seconds). Please retry later".format(archive_url, timeout))
+        print(f"Request timed out for {archive_url} (set to {timeout} seconds). Please retry later")
         return {"failed_url": archive_url}
 
-    with tempfile.TemporaryFile(mode='w+b') as temp_archive_name:   # read + write + binary mode
-        for chunk in r.iter_content(chunk_size=128):
-            temp_archive_name.write(chunk)
-        # Check a file is now present and it contains data
-        if os.stat(temp_archive_name.name).st_size > 0:
-            print("Download complete ({} bytes). Unpacking...".format(os.stat(temp_archive_name.name).st_size))
+    # Most archives are small enough to be held in memory, avoiding a write and read back through the filesystem.
+    # Fall back to a temporary file for large archives, or when the server doesn't tell us the size up front
+    content_length = int(r.headers.get("Content-Length", MAX_IN_MEMORY_ARCHIVE_BYTES + 1))
+    if content_length <= MAX_IN_MEMORY_ARCHIVE_BYTES:
+        archive_buffer = io.BytesIO()
+    else:
+        archive_buffer = tempfile.TemporaryFile(mode='w+b')    # read + write + binary mode
+
+    with archive_buffer as archive_file:
+        # Copy the response body in large blocks. decode_content undoes any transfer compression, as iter_content would
+        r.raw.decode_content = True
+        shutil.copyfileobj(r.raw, archive_file, 1024 * 1024)
+        # Check the download contains data. The write position is the number of bytes downloaded
+        archive_size = archive_file.tell()
+        if archive_size > 0:
+            print(f"Download complete ({archive_size} bytes)")
         else:
-            print("ERR: There was a problem downloading the archive file: {}".format(temp_archive_name.name))
-            sys.exit(1)
+            print(f"ERR: There was a problem downloading the archive file: {archive_url}")
+            return {"failed_url": archive_url}
 
-        # Unpack the archive to a temp directory
-        with tempfile.TemporaryDirectory() as temp_dir_name:
-            with zipfile.ZipFile(temp_archive_name, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir_name)
-            print("Finished unpacking")
+        # Read the archive in place. The book is decompressed straight into memory rather than extracted to disk
+        try:
+            zip_ref = zipfile.ZipFile(archive_file, 'r')
+        except zipfile.BadZipFile:
+            # e.g. the server returned an error page rather than the archive
+            print(f"ERR: Downloaded file is not a valid zip archive: {archive_url}")
+            return {"failed_url": archive_url}
+
+        with zip_ref:
 
-            # Find all the txt files which have been unpacked
-            list_of_txt_files = find_files_in_directory(filename_glob_pattern, temp_dir_name)
+            # Find all the txt files in the archive
+            list_of_txt_files = [name for name in zip_ref.namelist()
+                                 if fnmatch.fnmatch(os.path.basename(name), filename_glob_pattern)]
 
             # Output how many matching files have been found in the archive
-            print("There are {} file(s) matching the pattern '{}'"
-                  .format(len(list_of_txt_files), filename_glob_pattern))
+            print(f"There are {len(list_of_txt_files)} file(s) matching the pattern '{filename_glob_pattern}'")
 
             # Only one file found in the archive matching the pattern. Currently the only supported route
             if len(list_of_txt_files) == 1:
-                # Create Kafka Producer client
-                p = Producer(kafka_client_config)
-
                 # Process messages
-                result = process_book_in_full(client=p, file_path=list_of_txt_files[0],
+                result = process_book_in_full(client=client, archive=zip_ref, book_id=archive_url,
+                                              file_path=list_of_txt_files[0],
                                               prefix=title_regex_prefix, kafka_topic=topic)
 
-                # Successful book title lookup and messages have been sent to kafka
+                # Successful book title lookup and messages have been queued for kafka
                 if result:
-                    print("Waiting until all the messages have been delivered to the broker...")
-                    p.flush()
-
                     return result
 
                 # Keep track of books we failed to process
@@ -368,34 +504,79 @@ if __name__ == "__main__":
     FILENAME_GLOB_PATTERN = os.environ.get("FILENAME_GLOB_PATTERN")
     BASE_URL = os.environ.get("BASE_URL")
     STARTING_URI = os.environ.get("STARTING_URI")
-
-    kafka_client_config = {"bootstrap.servers": BOOTSTRAP_SERVERS}
+    MAX_WORKERS = int(os.environ.get("MAX_WORKERS", 4))
+    KAFKA_ACKS = os.environ.get("KAFKA_ACKS", "1")      # "all", "-1", "1" or "0". Passed through to librdkafka
+
+    # Let librdkafka batch and compress messages instead of sending each one as soon as it is produced
+    kafka_client_config = {
+        "bootstrap.servers": BOOTSTRAP_SERVERS,
+        "linger.ms": 50,                        # adds up to 50ms latency per message in exchange for larger batches
+        "batch.num.messages": 10000,            # max messages per batch
+        "queue.buffering.max.kbytes": 1048576,  # 1GB local producer queue. Workers can queue several books at once
+        "compression.type": "lz4",              # book text compresses well
+        "socket.keepalive.enable": True,        # keep idle broker connections open between archives
+        "error_cb": kafka_error_report,         # client level errors. Per message results go to delivery_report
+        # Durability vs throughput tradeoff. 1 only waits for the partition leader, so a message can be lost if the
+        # leader fails before it is replicated. all (-1) waits for every in-sync replica. 0 doesn't wait at all and
+        # gives no delivery guarantee. Book text can be re-scraped, so leader acks are the default
+        "acks": KAFKA_ACKS
+    }
     list_of_sending_stats = []
     list_of_failed_to_process_books = []
 
+    # One HTTP session for all requests, so connections are reused instead of opened per page or archive
+    http_session = create_http_session(pool_size=MAX_WORKERS)
+
     print("Starting Query...\n=================")
 
-    archive_links_list = retrieve_archive_links(BASE_URL, STARTING_URI, NUM_OF_BOOKS_TO_PROCESS, HTML_REQUEST_TIMEOUT)
+    archive_links_list = retrieve_archive_links(BASE_URL, STARTING_URI, NUM_OF_BOOKS_TO_PROCESS, HTML_REQUEST_TIMEOUT,
+                                                session=http_session)
     if not archive_links_list:
         print("ERR: Unable to retrieve any links. Exiting")
         sys.exit(3)
 
     if len(archive_links_list) > 0:
-        print("{} links retrieved".format(len(archive_links_list)))
-        print("Configured to process {} archive(s)".format(NUM_OF_BOOKS_TO_PROCESS))
-
-        # Iterate over the requested number of archives
-        for url in archive_links_list[:NUM_OF_BOOKS_TO_PROCESS]:
+        print(f"{len(archive_links_list)} links retrieved")
+        print(f"Configured to process {NUM_OF_BOOKS_TO_PROCESS} archive(s)")
 
-            # Download archive, unpack, determine book title and send to kafka for further processing
-            processed_result = process_archive(kafka_client_config, url, HTML_REQUEST_TIMEOUT, FILENAME_GLOB_PATTERN,
-                                               TITLE_REGEX_PREFIX, KAFKA_TOPIC)
+        # Create a single Kafka Producer client. It is thread safe so is shared by all the workers
+        p = Producer(kafka_client_config)
 
-            if processed_result.get('failed_url'):
-                # Keep track of books we failed to process
-                list_of_failed_to_process_books.append(processed_result['failed_url'])
-            else:
-                list_of_sending_stats.append(processed_result)
+        # Process the requested number of archives concurrently. Each one spends most of its time waiting on the
+        # network or in librdkafka, both of which release the GIL
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+
+                # Download archive, unpack, determine book title and send to kafka for further processing
+                futures = {executor.submit(process_archive, p, http_session, url, HTML_REQUEST_TIMEOUT,
+                                           FILENAME_GLOB_PATTERN, TITLE_REGEX_PREFIX, KAFKA_TOPIC): url
+                           for url in archive_links_list[:NUM_OF_BOOKS_TO_PROCESS]}
+
+                # Serve delivery callbacks from the main thread while the workers are busy downloading
+                pending_futures = set(futures)
+                while pending_futures:
+                    _, pending_futures = concurrent.futures.wait(pending_futures, timeout=0.1)
+                    p.poll(0)
+
+                for future, url in futures.items():
+                    try:
+                        processed_result = future.result()
+                    except Exception as e:
+                        # An unexpected error in one archive shouldn't lose the messages already queued for the others
+                        print(f"ERR: Failed to process archive {url}: {e!r}", file=sys.stderr)
+                        list_of_failed_to_process_books.append(url)
+                        continue
+
+                    if processed_result.get('failed_url'):
+                        # Keep track of books we failed to process
+                        list_of_failed_to_process_books.append(processed_result['failed_url'])
+                    else:
+                        list_of_sending_stats.append(processed_result)
+
+        finally:
+            # Always deliver whatever has been queued, even if processing was interrupted
+            print("\nWaiting until all the messages have been delivered to the broker...")
+            p.flush()
 
         # Display stats
         display_producer_stats(list_of_sending_stats, list_of_failed_to_process_books)